@@ -20,6 +20,9 @@ def get_args(parser=None):
         parser = argparse.ArgumentParser(description='High Quality Monocular Depth Estimation via Transfer Learning')
     parser.add_argument('--model', default='nyu.h5', type=str, help='Trained Keras model file.')
     parser.add_argument('--input', default='../Data/monodepth/input/*.png', type=str, help='Input filename or folder.')
+    # callers like auralize.py register --trt themselves, since they parse their arguments before the model is created
+    if parser.get_default('trt') is None:
+        parser.add_argument('--trt', default=0, type=int, help='Whether to run the model as a TensorRT FP16 engine. The engine is built and cached on first use.')
     args = parser.parse_args()
     return args
     
@@ -50,7 +53,13 @@ class MonoDepth:
         print('Loading model...')
 
         # Load model into GPU / CPU
-        self.model = load_model(args.model, custom_objects=custom_objects, compile=False)
+        if args.trt:
+            from trt_model import TRTModel
+            self.model = TRTModel(args.model, custom_objects=custom_objects)
+        else:
+            self.model = load_model(args.model, custom_objects=custom_objects, compile=False)
+            # Build the predict function now, it is not thread safe to build it lazily from a worker thread
+            self.model._make_predict_function()
         print('\nModel loaded ({0}).'.format(args.model))
         
     def prediction(self):
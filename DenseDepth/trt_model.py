@@ -0,0 +1,101 @@
+import os
+import hashlib
+
+import numpy as np
+import cv2
+import tensorrt as trt
+import torch
+
+
+# Range of input shapes (NHWC) the engine is built for. The depth model is fed
+# bounding box crops (plus margin, padded to multiples of 32), so optimize for those.
+min_shape = (1, 32, 32, 3)
+opt_shape = (1, 224, 224, 3)
+max_shape = (1, 1024, 1280, 3)
+
+
+def get_engine_path(model_path, fp16=True):
+    # Key the cached engine on the model weights and the shape profile, so changing either triggers a rebuild
+    sha1 = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        sha1.update(f.read())
+    sha1.update(repr((min_shape, opt_shape, max_shape)).encode())
+    digest = sha1.hexdigest()[:12]
+    precision = 'fp16' if fp16 else 'fp32'
+    return '{}.{}.{}.trt'.format(os.path.splitext(model_path)[0], digest, precision)
+
+
+def build_engine(model, engine_path, fp16=True):
+    import keras2onnx
+
+    onnx_model = keras2onnx.convert_keras(model, model.name)
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse(onnx_model.SerializeToString()):
+        errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+        raise RuntimeError('Failed to parse ONNX model:\n' + '\n'.join(errors))
+
+    config = builder.create_builder_config()
+    config.max_workspace_size = 1 << 30
+    if fp16 and builder.platform_has_fast_fp16:
+        config.set_flag(trt.BuilderFlag.FP16)
+    profile = builder.create_optimization_profile()
+    profile.set_shape(network.get_input(0).name, min_shape, opt_shape, max_shape)
+    config.add_optimization_profile(profile)
+
+    print('Building TensorRT engine, this takes a while...')
+    engine = builder.build_engine(network, config)
+    if engine is None:
+        raise RuntimeError('Failed to build TensorRT engine')
+    with open(engine_path, 'wb') as f:
+        f.write(engine.serialize())
+    print('TensorRT engine saved ({0}).'.format(engine_path))
+
+
+# Runs a Keras model through a cached TensorRT engine, with the predict() interface used by utils.predict
+class TRTModel:
+    def __init__(self, model_path, custom_objects=None, fp16=True):
+        engine_path = get_engine_path(model_path, fp16)
+        if not os.path.isfile(engine_path):
+            from keras.models import load_model
+            model = load_model(model_path, custom_objects=custom_objects, compile=False)
+            build_engine(model, engine_path, fp16)
+
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, 'rb') as f, trt.Runtime(logger) as runtime:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        self.device = torch.device('cuda')
+
+        # Input buffers for the largest supported shape, allocated once. Pinned host
+        # memory allows a fast DMA copy to the device.
+        self.host_input = torch.empty(max_shape, dtype=torch.float32).pin_memory()
+        self.device_input = torch.empty(max_shape, dtype=torch.float32, device=self.device)
+
+    def predict(self, images, batch_size=None):
+        # the engine is built for batch size 1
+        if images.shape[0] > 1:
+            return np.concatenate([self.predict(images[i:i+1]) for i in range(images.shape[0])])
+
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        height, width = images.shape[1:3]
+        if height > max_shape[1] or width > max_shape[2]:
+            # downscale inputs larger than the engine profile, keeping the aspect ratio and multiples of 32.
+            # The depth map is smaller then, callers resize it to their input size anyway.
+            scale = min(max_shape[1] / height, max_shape[2] / width)
+            size = (int(width * scale) // 32 * 32, int(height * scale) // 32 * 32)
+            images = cv2.resize(images[0], size, interpolation=cv2.INTER_AREA)[np.newaxis]
+
+        # contiguous views on the front of the preallocated buffers
+        host_input = self.host_input.view(-1)[:images.size].view(images.shape)
+        inputs = self.device_input.view(-1)[:images.size].view(images.shape)
+        host_input.copy_(torch.from_numpy(images))
+        inputs.copy_(host_input)
+
+        self.context.set_binding_shape(0, tuple(inputs.shape))
+        outputs = torch.empty(tuple(self.context.get_binding_shape(1)), dtype=torch.float32, device=self.device)
+        self.context.execute_v2([int(inputs.data_ptr()), int(outputs.data_ptr())])
+        return outputs.cpu().numpy()
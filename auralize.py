@@ -3,13 +3,15 @@ import cv2
 import argparse
 import sys
 import time
+import signal
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 sys.path.insert(0, "./DenseDepth/")
 
-from PIL import Image
-
 from calibration.webcam import Webcam
-from calibration.calibrate import undistort_image
-from video_input import VideoInput
+from calibration.calibrate import undistort_image, undistort_image_cuda, cuda_available
+from video_input import VideoInput, VideoInputAV
 from object_detection.detect_YCB import YOLO
 from audio_playground.Audio import Audio
 from DenseDepth.monodepth import MonoDepth
@@ -26,21 +28,31 @@ except FileNotFoundError:
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", default="object_detection/input/video/ycb_seq1.mp4", type=str, help="Data source. Either cam or path to data.")
+parser.add_argument("--decoder", choices=["cv2", "av", "av_cuda"], default="cv2", help="Video file decoder: cv2.VideoCapture, PyAV with threaded decoding, or PyAV with CUDA (NVDEC) decoding.")
 parser.add_argument("--mono", choices=["none", "mono", "bts"], default="none", help="Whether to use monocular depth estimation.")
 parser.add_argument("--mp", default=0, type=int, help="Whether to use multiprocessing for the camera input. Not working for windows OS.")
 parser.add_argument("--yolomodel", default=0, type=int, help="Whether to use YCB-model (0) or COCO (1).")
 parser.add_argument("--object", default=0, type=int, help="Which object to search for.")
+parser.add_argument("--trt", default=0, type=int, help="Whether to run the DenseDepth model (--mono mono) as a TensorRT FP16 engine. The engine is built and cached on first use.")
+parser.add_argument("--yolo_onnx", default=0, type=int, help="Whether to run YOLO as an FP16 ONNX model with ONNXRuntime (CUDA if available). The model is exported on first use.")
 parser.add_argument("--slam", default=0, type=int, help="Whether to use slam")
+parser.add_argument("--skip_threshold", default=0., type=float, help="Mean absolute difference (0-255) of a 32x32 grayscale thumbnail below which a frame counts as unchanged and detection and depth estimation are skipped. 0 disables skipping, 2 is a reasonable value.")
+parser.add_argument("--stride", default=10, type=int, help="Force a new detection at least every this many frames when skipping unchanged frames.")
+parser.add_argument("--cuda_undistort", default=0, type=int, help="Whether to undistort frames on the GPU (needs OpenCV built with CUDA). The upload and download can outweigh the gain for small frames, so compare against the CPU path first.")
+parser.add_argument("--display", default=1, type=int, help="Whether to show the camera feed and depth windows. Without display, quit with Ctrl+C.")
+parser.add_argument("--pipeline", default=0, type=int, help="Whether to run capture, detection and depth estimation as a pipeline of threads. Frames are dropped if a stage falls behind.")
 args = parser.parse_args()
 
 # Instantiate all algorithms
 use_mono_depth = args.mono != "none"
 if args.s == "cam":
     cam = Webcam(sequential=not args.mp)
-else:
+elif args.decoder == "cv2":
     cam = VideoInput(args.s)
+else:
+    cam = VideoInputAV(args.s, hwaccel="cuda" if args.decoder == "av_cuda" else None)
 
-yolo = YOLO(path_extension="object_detection", model=args.yolomodel)
+yolo = YOLO(path_extension="object_detection", model=args.yolomodel, onnx=bool(args.yolo_onnx))
 audio = Audio("audio_playground/sound.wav", volume_factor=0.1)
 
 if use_mono_depth:
@@ -50,6 +62,13 @@ if use_mono_depth:
         depth_model = BTS(parser)
     depth_model.eval()
 
+use_cuda = bool(args.cuda_undistort)
+if use_cuda and not cuda_available():
+    print("No CUDA device available to OpenCV, undistorting on the CPU.")
+    use_cuda = False
+if use_cuda:
+    gpu_frame = cv2.cuda_GpuMat()
+
 use_slam = args.slam
 if use_slam:
     slam = ORBSLAM2(useViewer=False)
@@ -62,51 +81,102 @@ num_classes = yolo.get_num_classes()
 # Get camera feed from camera object
 cam.start()
 
+# Pixels of context around the bounding box fed into the depth model
+depth_roi_margin = 32
+
+# Images to be shown by the main thread, cv2 windows can only be updated from there
+display_images = {}
+
+def show_image(name, img):
+    if args.display:
+        display_images[name] = img
+
 def get_position_bbox(img, out_box):
     top, left, bottom, right = out_box
     center_x = (right - left) / 2 + left
     center_y = (bottom - top) / 2 + top
 
-    im_width, im_height, _ = img.shape
+    im_height, im_width = img.shape[:2]
 
     pos_x = (center_x - im_width / 2) / im_width
     pos_y = (center_y - im_height / 2) / im_height
     left, right, top, bottom = int(left), int(right), int(top), int(bottom)
-    #print("coords: ", left, right, top, bottom)
-    #print(im_width, im_height)
 
     return [pos_x, pos_y, 1.0]
 
+def get_depth_roi(out_box, height, width, margin=depth_roi_margin):
+    # bounding box plus a margin for context, clipped to the image and padded to multiples of 32 for the depth models
+    top, left, bottom, right = map(lambda x: int(x), out_box)
+    top, left = max(top - margin, 0), max(left - margin, 0)
+    bottom, right = min(bottom + margin, height), min(right + margin, width)
+    pad_bottom = -(bottom - top) % 32
+    pad_right = -(right - left) % 32
+    return top, left, bottom, right, pad_bottom, pad_right
+
 def get_depth(depth_map, out_box):
     top, left, bottom, right = map(lambda x: int(x), out_box)
+    # clip the box to the depth map and keep at least one pixel, an empty box would yield NaN
+    height, width = depth_map.shape[:2]
+    top, left = min(max(top, 0), height - 1), min(max(left, 0), width - 1)
+    bottom, right = max(min(bottom, height), top + 1), max(min(right, width), left + 1)
     depth_box = depth_map[top:bottom, left:right]
-    #print("Depth box shape: ", depth_box.shape)
-    cv2.imshow("Depth box of object", depth_box)
-    pos_z = depth_box.mean()
+    show_image("Depth box of object", depth_box)
+    # median is robust against background pixels inside the box
+    pos_z = np.median(depth_box)
     #cv2.imshow("Depth box in orig img", img[top:bottom, left:right, :])
 
     return pos_z
 
-def process_frame(frame):
-    frame_np = np.array(Image.fromarray(frame))
+def prepare_frame(frame):
+    frame_np = frame if isinstance(frame, np.ndarray) else np.asarray(frame)
     # First, calibrate the frame:
-    frame_np = undistort_image(frame_np, camera_matrix, dist_coefs)
-    height, width = frame_np.shape[:2]
-    frame_PIL = Image.fromarray(frame_np)
-
-    # Feed camera feed into object detection algorithm to get bounding boxes
-    # Show bounding boxes in feed
-    yolo_image, out_box = yolo.detect_image(frame_PIL, search_object_class)
-    yolo_image = np.array(yolo_image)
+    if use_cuda:
+        gpu_frame.upload(frame_np)
+        frame_np = undistort_image_cuda(gpu_frame, camera_matrix, dist_coefs).download()
+    else:
+        frame_np = undistort_image(frame_np, camera_matrix, dist_coefs)
+    return frame_np
+
+# Thumbnail of the frame of the last detection, to detect unchanged frames
+detection_thumbnail = None
+frames_since_detection = 0
+
+def is_unchanged_frame(frame_np):
+    global detection_thumbnail, frames_since_detection
+    gray = cv2.cvtColor(frame_np, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    # compare against the last detected frame, so slow changes still trigger a new detection
+    unchanged = detection_thumbnail is not None and frames_since_detection < args.stride \
+        and np.mean(np.abs(thumbnail - detection_thumbnail)) < args.skip_threshold
+    if unchanged:
+        frames_since_detection += 1
+    else:
+        detection_thumbnail = thumbnail
+        frames_since_detection = 0
+    return unchanged
 
+def detect_objects(frame, frame_np):
     if use_slam:
         slam.track_monocular(frame, time.time())
         print("slam pose estimation: {}".format(slam.pose))
-        if slam.initialized:
-            yolo_image = slam.draw_keypoints(yolo_image)
-            print("Scale: {}".format(slam.scale))
 
-    cv2.imshow("Auralizer", yolo_image)
+    # Keep the previous detection and object position if the frame hardly changed
+    if args.skip_threshold > 0 and is_unchanged_frame(frame_np):
+        return None
+
+    # Feed camera feed into object detection algorithm to get bounding boxes
+    # Show bounding boxes in feed, drawn on a copy since frame_np is still needed for depth estimation
+    yolo_image, out_box = yolo.detect_image_np(frame_np.copy(), search_object_class)
+
+    if use_slam and slam.initialized:
+        yolo_image = slam.draw_keypoints(yolo_image)
+        print("Scale: {}".format(slam.scale))
+
+    show_image("Auralizer", yolo_image)
+    return yolo_image, out_box
+
+def localize_object(frame_np, yolo_image, out_box):
+    height, width = frame_np.shape[:2]
 
     if out_box is not None:
 
@@ -118,26 +188,27 @@ def process_frame(frame):
         # Show depth map
         if use_mono_depth and not use_slam:
             start_time = time.time()
-            depth_map = depth_model.forward(frame_np)
+            # Only the depth around the object is used, so only run the model on that region
+            roi_top, roi_left, roi_bottom, roi_right, pad_bottom, pad_right = get_depth_roi(out_box, height, width)
+            roi = frame_np[roi_top:roi_bottom, roi_left:roi_right]
+            roi = cv2.copyMakeBorder(roi, 0, pad_bottom, 0, pad_right, cv2.BORDER_REPLICATE)
+            depth_map = depth_model.forward(roi)
             #print("Time Depth Est: ", round(time.time() - start_time, 1))
             depth_map = depth_map.squeeze()
             # Upsample the depth map:
             if args.mono == "bts":
                 depth_map = depth_map.numpy()
             else:
-                depth_map = np.array(Image.fromarray(depth_map).resize((width, height)))
-            #print("mean: ", depth_map.mean())
-            #print("std: ", depth_map.std())
-            #print("section: ", depth_map[:10, :10])
-            #print("depth map shape: ", depth_map.shape)
+                depth_map = cv2.resize(depth_map, (roi.shape[1], roi.shape[0]), interpolation=cv2.INTER_LINEAR)
+            depth_map = depth_map[:roi_bottom - roi_top, :roi_right - roi_left]
             #cv2.imshow("Full depth image", depth_map)
             # normalize depth map:
             #depth_map = (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min())
             #cv2.imshow("Normed depth image", depth_map)
-            # get distance by averaging over depth in depth_box
-            distance = get_depth(depth_map, out_box)
+            # get distance from the median depth in depth_box
+            top, left, bottom, right = out_box
+            distance = get_depth(depth_map, (top - roi_top, left - roi_left, bottom - roi_top, right - roi_left))
             # scale distance for better volume behavior
-            print("Distance before scaling: ", distance)
             if args.mono == "bts":
                 distance = max(distance - 13, 0) * 0.3
             else:
@@ -154,7 +225,6 @@ def process_frame(frame):
             distance = 1 - proportion
             # scale distance for better volume behavior
             # (distance is in range 0.5-0.8, after scaling in 0-6)
-            print("Distance before scaling: ", distance)
             distance = max((distance - 0.5), 0) * 20
             # assign to distance:
             object_position[2] = distance
@@ -196,27 +266,103 @@ def process_frame(frame):
             audio.stop()
             print()
 
+def process_frame(frame):
+    frame_np = prepare_frame(frame)
+    detection = detect_objects(frame, frame_np)
+    if detection is not None:
+        localize_object(frame_np, *detection)
+
+# Pipeline stages, each stage hands its newest result to the next one through a single slot queue
+stop_event = threading.Event()
+cap_q = queue.Queue(maxsize=1)
+det_q = queue.Queue(maxsize=1)
+
+def put_latest(q, item):
+    # drop the pending item if the next stage did not fetch it yet
+    if q.full():
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+    q.put(item)
+
+def capture_worker():
+    while not stop_event.is_set():
+        frame = cam.get_current_frame()
+        if frame is not None:
+            put_latest(cap_q, (frame, prepare_frame(frame)))
+
+def detection_worker():
+    while not stop_event.is_set():
+        try:
+            frame, frame_np = cap_q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        detection = detect_objects(frame, frame_np)
+        if detection is not None:
+            put_latest(det_q, (frame_np,) + detection)
+
+def localization_worker():
+    while not stop_event.is_set():
+        try:
+            frame_np, yolo_image, out_box = det_q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        localize_object(frame_np, yolo_image, out_box)
+
 def clean_up():
+    stop_event.set()
+    if args.pipeline:
+        executor.shutdown(wait=True)
     audio.__del__()
 
-while True:
-    frame = cam.get_current_frame()
-    if frame is not None:
-        process_frame(frame)
+# Without display there is no window to poll keys from, quit on SIGINT instead
+quit_event = threading.Event()
+if not args.display:
+    signal.signal(signal.SIGINT, lambda signum, frame: quit_event.set())
 
-    key = cv2.waitKey(1) & 0xFF
+if args.pipeline:
+    executor = ThreadPoolExecutor(max_workers=3)
+    workers = [executor.submit(worker) for worker in (capture_worker, detection_worker, localization_worker)]
 
-    if key == ord('q'):
-        clean_up()
-        break
+# Stop the pipeline workers on every exit path (q, worker error, Ctrl+C, display errors),
+# otherwise the interpreter waits for them forever on exit
+try:
+    while True:
+        if args.pipeline:
+            # workers only return on errors, re-raise them here
+            failed = [worker for worker in workers if worker.done()]
+            if failed:
+                failed[0].result()
+                break
+        else:
+            frame = cam.get_current_frame()
+            if frame is not None:
+                process_frame(frame)
 
-    # Count up or down
-    if key == ord('1') or key == ord('2'):
-        if key == ord('1'):
-            search_object_class -= 1
-        if key == ord('2'):
-            search_object_class += 1
+        if args.display:
+            for name in list(display_images):
+                cv2.imshow(name, display_images.pop(name))
 
-        search_object_class = search_object_class % (num_classes - 1)
-        #slam.last_tracked_object = None
-        audio.stop()
+            key = cv2.waitKey(1) & 0xFF
+        else:
+            if args.pipeline:
+                # the workers do the processing, do not spin while waiting for them
+                quit_event.wait(0.01)
+            key = ord('q') if quit_event.is_set() else 0xFF
+
+        if key == ord('q'):
+            break
+
+        # Count up or down
+        if key == ord('1') or key == ord('2'):
+            if key == ord('1'):
+                search_object_class -= 1
+            if key == ord('2'):
+                search_object_class += 1
+
+            search_object_class = search_object_class % (num_classes - 1)
+            #slam.last_tracked_object = None
+            audio.stop()
+finally:
+    clean_up()
@@ -15,21 +15,52 @@ import numpy as np
 import cv2 as cv
 import getopt
 from glob import glob
+from multiprocessing import Pool
 import yaml
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY
+except ImportError:
+    TurboJPEG = None
+
 
 # CHESSBOARD SIZE
 pattern_size = (11, 7)
 
+# Optimal new camera matrices and undistortion maps, computed once per (image size, camera matrix, dist coefs)
+_new_camera_matrix_cache = {}
+_remap_cache = {}
+# Same maps uploaded to the GPU for the CUDA undistortion path, and reused output images
+_gpu_remap_cache = {}
+_gpu_dst_cache = {}
+# libjpeg-turbo decoder, created on first use
+_turbo_jpeg = None
+
 
 def splitfn(fn):
     path, fn = os.path.split(fn)
     name, ext = os.path.splitext(fn)
     return path, name, ext
 
+def read_gray_image(fn):
+    global _turbo_jpeg
+    if TurboJPEG is not None and splitfn(fn)[2].lower() in ('.jpg', '.jpeg'):
+        if _turbo_jpeg is None:
+            _turbo_jpeg = TurboJPEG()
+        with open(fn, 'rb') as f:
+            return _turbo_jpeg.decode(f.read(), pixel_format=TJPF_GRAY)[:, :, 0]
+    return cv.imread(fn, 0)
+
+def init_worker(*config):
+    # one OpenCV thread per worker, the pool already uses all cores
+    cv.setNumThreads(1)
+    # the module globals set in __main__ are not available in spawned worker processes
+    global h, w, debug_dir, pattern_points
+    h, w, debug_dir, pattern_points = config
+
 def processImage(fn):
     print('processing %s... ' % fn)
-    img = cv.imread(fn, 0)
+    img = read_gray_image(fn)
     if img is None:
         print("Failed to load", fn)
         return None
@@ -64,30 +95,76 @@ def get_chessboard_info(h, w):
     if threads_num <= 1:
         chessboards = [processImage(fn) for fn in img_names]
     else:
-        print("Run with %d threads..." % threads_num)
-        from multiprocessing.dummy import Pool as ThreadPool
-        pool = ThreadPool(threads_num)
-        chessboards = pool.map(processImage, img_names)
+        print("Run with %d processes..." % threads_num)
+        with Pool(threads_num, initializer=init_worker, initargs=(h, w, debug_dir, pattern_points)) as pool:
+            chessboards = pool.map(processImage, img_names)
 
     chessboards = [x for x in chessboards if x is not None]
-    for (corners, pattern_points) in chessboards:
+    for (corners, points) in chessboards:
         img_points.append(corners)
-        obj_points.append(pattern_points)
+        obj_points.append(points)
 
     return img_points, obj_points
 
 
+def _get_calibration_key(size, camera_matrix, dist_coefs):
+    # key on the content, the arrays may be reloaded or modified in place
+    h, w = size
+    return (camera_matrix.tobytes(), dist_coefs.tobytes(), h, w)
+
+
+def get_new_camera_matrix(size, camera_matrix, dist_coefs):
+    key = _get_calibration_key(size, camera_matrix, dist_coefs)
+    if key not in _new_camera_matrix_cache:
+        h, w = size
+        _new_camera_matrix_cache[key] = cv.getOptimalNewCameraMatrix(camera_matrix, dist_coefs, (w, h), 1, (w, h))
+    return _new_camera_matrix_cache[key]
+
+
+def _get_undistort_maps(size, camera_matrix, dist_coefs):
+    h, w = size
+    key = _get_calibration_key(size, camera_matrix, dist_coefs)
+    if key not in _remap_cache:
+        newcameramtx, roi = get_new_camera_matrix(size, camera_matrix, dist_coefs)
+        map1, map2 = cv.initUndistortRectifyMap(camera_matrix, dist_coefs, None, newcameramtx, (w, h), cv.CV_16SC2)
+        _remap_cache[key] = (map1, map2)
+    return key, _remap_cache[key]
+
+
 def undistort_image(img, camera_matrix, dist_coefs):
-    h, w = img.shape[:2]
-    newcameramtx, roi = cv.getOptimalNewCameraMatrix(camera_matrix, dist_coefs, (w, h), 1, (w, h))
+    _, (map1, map2) = _get_undistort_maps(img.shape[:2], camera_matrix, dist_coefs)
 
-    dst = cv.undistort(img, camera_matrix, dist_coefs, None, newcameramtx)
+    dst = cv.remap(img, map1, map2, cv.INTER_LINEAR)
 
     # crop the image
     #x, y, w, h = roi
     #dst = dst[y:y+h, x:x+w]
     return dst
 
+
+def cuda_available():
+    return hasattr(cv, "cuda") and cv.cuda.getCudaEnabledDeviceCount() > 0
+
+
+def undistort_image_cuda(gpu_img, camera_matrix, dist_coefs):
+    w, h = gpu_img.size()
+    key, (map1, map2) = _get_undistort_maps((h, w), camera_matrix, dist_coefs)
+    if key not in _gpu_remap_cache:
+        # cuda.remap only takes float maps, so convert the fixed-point ones before uploading
+        map_x, map_y = cv.convertMaps(map1, map2, cv.CV_32FC1)
+        gpu_map_x, gpu_map_y = cv.cuda_GpuMat(), cv.cuda_GpuMat()
+        gpu_map_x.upload(map_x)
+        gpu_map_y.upload(map_y)
+        _gpu_remap_cache[key] = (gpu_map_x, gpu_map_y)
+    gpu_map_x, gpu_map_y = _gpu_remap_cache[key]
+
+    # reuse the output image instead of allocating device memory every frame
+    dst_key = (h, w, gpu_img.type())
+    if dst_key not in _gpu_dst_cache:
+        _gpu_dst_cache[dst_key] = cv.cuda_GpuMat(h, w, gpu_img.type())
+
+    return cv.cuda.remap(gpu_img, gpu_map_x, gpu_map_y, cv.INTER_LINEAR, dst=_gpu_dst_cache[dst_key])
+
 def write_yaml_config(camera_matrix, dist_coefs):
     template_path = "./orbslam_config_template.yaml"
     save_path = "./orbslam_config.yaml"
@@ -133,7 +210,8 @@ if __name__ == '__main__':
     pattern_points[:, :2] = np.indices(pattern_size).T.reshape(-1, 2)
     pattern_points *= square_size
 
-    h, w = cv.imread(img_names[0], cv.IMREAD_GRAYSCALE).shape[:2]  # TODO: use imquery call to retrieve results
+    # read with the same decoder as the workers, TurboJPEG ignores EXIF orientation unlike cv.imread
+    h, w = read_gray_image(img_names[0]).shape[:2]  # TODO: use imquery call to retrieve results
 
     img_points, obj_points = get_chessboard_info(h, w)
 
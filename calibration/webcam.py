@@ -1,12 +1,21 @@
 import numpy as np
 import cv2
-import time
 
 from multiprocessing import Process, Queue, Value
+from queue import Empty
 
 class Webcam:
-    def __init__(self, camera_num=0, sequential=True):
+    def __init__(self, camera_num=0, sequential=True, width=None, height=None, fourcc=None):
         self.cap = cv2.VideoCapture(camera_num)
+        # only keep the newest frame in the driver queue, otherwise reads lag behind the live feed
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        if fourcc is not None:
+            # e.g. 'MJPG' avoids the YUY2 -> BGR conversion on most webcams
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if width is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
         
         self.sequential = sequential
         if not self.sequential:
@@ -14,7 +23,7 @@ class Webcam:
             self.ret = None 
             
             self.is_running = Value('i',1)        
-            self.q = Queue(maxsize=2)        
+            self.q = Queue(maxsize=1)        
             self.vp = Process(target=self._update_frame, args=(self.q,self.is_running,))
             self.vp.daemon = True
 
@@ -40,11 +49,13 @@ class Webcam:
             self.ret, self.current_frame = self.cap.read()
             if self.ret is True: 
                 #self.current_frame= self.cap.read()[1]
+                # always publish the newest frame, drop the one the consumer did not fetch yet
                 if q.full():
-                    old_frame = self.q.get()
-                self.q.put(self.current_frame)
-                #print('q.size: ', self.q.qsize())           
-        time.sleep(0.005)
+                    try:
+                        q.get_nowait()
+                    except Empty:
+                        pass
+                q.put(self.current_frame)
                   
     # get the current frame
     def get_current_frame(self):
@@ -52,8 +63,10 @@ class Webcam:
             frame = self._update_frame_sequential()
             return frame
         else:
-            img = None 
-            while not self.q.empty():  # get last available image
-                img = self.q.get()         
-            return img
+            # fall back to the last frame if no new one arrives in time
+            try:
+                self.current_frame = self.q.get(timeout=0.033)
+            except Empty:
+                pass
+            return self.current_frame
 
@@ -7,15 +7,15 @@ import os
 from timeit import default_timer as timer
 
 import numpy as np
+import cv2
 from keras import backend as K
 from keras.models import load_model
 from keras.layers import Input
 from keras.utils import multi_gpu_model
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image
 
 from .keras_yolo3.yolo3.model import yolo_eval, yolo_body, tiny_yolo_body
-from .keras_yolo3.yolo3.utils import letterbox_image
 
 class YOLO(object):
     _defaults = {
@@ -26,6 +26,8 @@ class YOLO(object):
         "iou": 0.45,
         "model_image_size": (416, 416),
         "gpu_num" : 1,
+        "debug": False,
+        "onnx": False,
     }
 
     @classmethod
@@ -49,8 +51,18 @@ class YOLO(object):
 
         self.class_names = self._get_class()
         self.anchors = self._get_anchors()
-        self.sess = K.get_session()
-        self.boxes, self.scores, self.classes = self.generate()
+        # Letterboxed and normalized model input, reused across frames
+        # (reallocated on the first frame if the model size follows the image size)
+        if self.model_image_size != (None, None):
+            self._infer_buf = np.empty((1,) + tuple(self.model_image_size) + (3,), dtype=np.float32)
+        else:
+            self._infer_buf = np.empty((1, 0, 0, 3), dtype=np.float32)
+        self._letterbox_size = None
+        if self.onnx:
+            self.onnx_model = self.generate_onnx()
+        else:
+            self.sess = K.get_session()
+            self.boxes, self.scores, self.classes = self.generate()
 
 
     def _get_class(self):
@@ -70,7 +82,7 @@ class YOLO(object):
     def get_num_classes(self):
         return len(self.class_names)
 
-    def generate(self):
+    def _load_yolo_model(self):
         model_path = os.path.expanduser(self.model_path)
         assert model_path.endswith('.h5'), 'Keras model or weights must be a .h5 file.'
 
@@ -91,6 +103,20 @@ class YOLO(object):
 
         print('{} model, anchors, and classes loaded.'.format(model_path))
 
+    def generate_onnx(self):
+        from .yolo_onnx import YOLOOnnx, get_onnx_path, export_onnx
+
+        # Export the model body to ONNX (FP16) once, box decoding is done in NumPy
+        onnx_path = get_onnx_path(os.path.expanduser(self.model_path))
+        if not os.path.isfile(onnx_path):
+            self._load_yolo_model()
+            export_onnx(self.yolo_model, onnx_path)
+        return YOLOOnnx(onnx_path, self.anchors, len(self.class_names),
+                score_threshold=self.score, iou_threshold=self.iou)
+
+    def generate(self):
+        self._load_yolo_model()
+
         # Generate output tensor targets for filtered bounding boxes.
         self.input_image_shape = K.placeholder(shape=(2, ))
         if self.gpu_num>=2:
@@ -100,47 +126,78 @@ class YOLO(object):
                 score_threshold=self.score, iou_threshold=self.iou)
         return boxes, scores, classes
 
+    def _letterbox_image(self, image, size, bgr=False):
+        '''resize image with unchanged aspect ratio using padding, normalized into the inference buffer'''
+        ih, iw = image.shape[:2]
+        h, w = size
+        scale = min(w/iw, h/ih)
+        nw = int(iw*scale)
+        nh = int(ih*scale)
+
+        if self._infer_buf.shape[1:3] != (h, w):
+            self._infer_buf = np.empty((1, h, w, 3), dtype=np.float32)
+            self._letterbox_size = None
+        # the padding only needs to be refilled when the resized image size changes
+        if self._letterbox_size != (nh, nw):
+            self._infer_buf.fill(128 / 255.)
+            self._letterbox_size = (nh, nw)
+
+        top, left = (h-nh)//2, (w-nw)//2
+        resized = cv2.resize(image, (nw, nh), interpolation=cv2.INTER_AREA)
+        if bgr:
+            # the model expects RGB input, swap channels with a view so it is fused with the scaling
+            resized = resized[..., ::-1]
+        np.multiply(resized, np.float32(1 / 255.), out=self._infer_buf[0, top:top+nh, left:left+nw], dtype=np.float32)
+        return self._infer_buf
+
     def detect_image(self, image, search_object_class):
+        # PIL images are RGB, draw on an ndarray copy
+        return self.detect_image_np(np.array(image), search_object_class, bgr=False)
+
+    def detect_image_np(self, image, search_object_class, bgr=True):
+        '''detect on an ndarray image (BGR by default, as read by cv2), the detection is drawn onto image in place'''
         start = timer()
+        im_height, im_width = image.shape[:2]
 
         if self.model_image_size != (None, None):
             assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
             assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
-            boxed_image = letterbox_image(image, tuple(reversed(self.model_image_size)))
+            image_data = self._letterbox_image(image, self.model_image_size, bgr)
+        else:
+            new_image_size = (im_height - (im_height % 32),
+                              im_width - (im_width % 32))
+            image_data = self._letterbox_image(image, new_image_size, bgr)
+
+        if self.onnx:
+            out_boxes, out_scores, out_classes = self.onnx_model.run(
+                image_data, [im_height, im_width])
         else:
-            new_image_size = (image.width - (image.width % 32),
-                              image.height - (image.height % 32))
-            boxed_image = letterbox_image(image, new_image_size)
-        image_data = np.array(boxed_image, dtype='float32')
-
-        image_data /= 255.
-        image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
-
-        out_boxes, out_scores, out_classes = self.sess.run(
-            [self.boxes, self.scores, self.classes],
-            feed_dict={
-                self.yolo_model.input: image_data,
-                self.input_image_shape: [image.size[1], image.size[0]],
-                K.learning_phase(): 0
-            })
-
-        search_object_index = -1
+            out_boxes, out_scores, out_classes = self.sess.run(
+                [self.boxes, self.scores, self.classes],
+                feed_dict={
+                    self.yolo_model.input: image_data,
+                    self.input_image_shape: [im_height, im_width],
+                    K.learning_phase(): 0
+                })
+
         box = None
 
+        if self.debug:
+            for detected_object in zip(out_boxes, out_scores, out_classes):
+                print('Detected Object: {}, Bbox: {}, Confidence: {}'.format(
+                    self.class_names[detected_object[2]], np.round(detected_object[0], 0), round(detected_object[1], 2)))
+
         # Select bounding box of demanded object class with highest score
-        for i, detected_object in enumerate(zip(out_boxes, out_scores, out_classes)):
-            max_score = 0
-            print('Detected Object: {}, Bbox: {}, Confidence: {}'.format(
-                self.class_names[detected_object[2]], np.round(detected_object[0], 0), round(detected_object[1], 2)))
-            if detected_object[2] == search_object_class and detected_object[1] > max_score:
-                max_score = detected_object[1]
-                search_object_index = i
+        search_mask = out_classes == search_object_class
+        if search_mask.any():
+            search_object_index = int(np.argmax(np.where(search_mask, out_scores, -np.inf)))
+        else:
+            search_object_index = -1
 
         #print('Found {} Object(s)'.format(len(out_boxes)))
 
-        font = ImageFont.truetype(font='object_detection/keras_yolo3/font/FiraMono-Medium.otf',
-                    size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
-        draw = ImageDraw.Draw(image)
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale = 1e-3 * im_height
         color = (0,255,255)
 
         if search_object_index > -1:
@@ -149,42 +206,43 @@ class YOLO(object):
             score = out_scores[search_object_index]
 
             label = '{} {:.2f}'.format(predicted_class, score)
-            label_size = draw.textsize(label, font)
+            (label_width, label_height), baseline = cv2.getTextSize(label, font, font_scale, 1)
+            label_height += baseline
 
             top, left, bottom, right = box
             top = max(0, np.floor(top + 0.5).astype('int32'))
             left = max(0, np.floor(left + 0.5).astype('int32'))
-            bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-            right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
-            print(label, (left, top), (right, bottom))
+            bottom = min(im_height, np.floor(bottom + 0.5).astype('int32'))
+            right = min(im_width, np.floor(right + 0.5).astype('int32'))
+            if self.debug:
+                print(label, (left, top), (right, bottom))
 
-            if top - label_size[1] >= 0:
-                text_origin = np.array([left, top - label_size[1]])
+            if top - label_height >= 0:
+                text_top = top - label_height
             else:
-                text_origin = np.array([left, top + 1])
+                text_top = top + 1
 
             # Draw BBox + Label
-            thickness = (image.size[0] + image.size[1]) // 300
-            for j in range(thickness):
-                draw.rectangle(
-                    [left + j, top + j, right - j, bottom - j],
-                    outline=color)
-            draw.rectangle(
-                [tuple(text_origin), tuple(text_origin + label_size)],
-                fill=color)
-            draw.text(text_origin, label, fill=(0, 0, 0), font=font)
+            thickness = max(1, (im_width + im_height) // 300)
+            cv2.rectangle(image, (left, top), (right, bottom), color, thickness)
+            cv2.rectangle(image, (left, text_top), (left + label_width, text_top + label_height), color, cv2.FILLED)
+            cv2.putText(image, label, (left, text_top + label_height - baseline), font, font_scale, (0, 0, 0), 1, cv2.LINE_AA)
 
         text_search = 'Search for {}. '.format(self.class_names[search_object_class])
-        draw.rectangle([(5, 5), tuple(draw.textsize(text_search, font))], fill=color)
-        draw.text([5, 5], text_search, fill=(0, 0, 0), font=font)
-        del draw
+        (text_width, text_height), baseline = cv2.getTextSize(text_search, font, font_scale, 1)
+        cv2.rectangle(image, (5, 5), (5 + text_width, 5 + text_height + baseline), color, cv2.FILLED)
+        cv2.putText(image, text_search, (5, 5 + text_height), font, font_scale, (0, 0, 0), 1, cv2.LINE_AA)
 
-        end = timer()
-        print('YOLO detection time: {}\n'.format(round(end - start, 1)))
+        if self.debug:
+            end = timer()
+            print('YOLO detection time: {}\n'.format(round(end - start, 1)))
         return image, box
 
     def close_session(self):
-        self.sess.close()
+        if self.onnx:
+            self.onnx_model.close()
+        else:
+            self.sess.close()
 
 
 def detect_video(yolo, video_path, output_path=""):
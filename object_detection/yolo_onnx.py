@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+ONNXRuntime inference for the YOLO_v3 body, with the yolo_eval box decoding done in NumPy
+"""
+
+import os
+
+import numpy as np
+import onnxruntime as ort
+
+
+def get_onnx_path(model_path, fp16=True):
+    return os.path.splitext(model_path)[0] + ('.fp16' if fp16 else '') + '.onnx'
+
+
+def export_onnx(yolo_model, onnx_path, fp16=True):
+    import keras2onnx
+
+    onnx_model = keras2onnx.convert_keras(yolo_model, yolo_model.name)
+    if fp16:
+        from onnxconverter_common.float16 import convert_float_to_float16
+        # keep float32 inputs and outputs, so the feeding and decoding code does not change
+        onnx_model = convert_float_to_float16(onnx_model, keep_io_types=True)
+    keras2onnx.save_model(onnx_model, onnx_path)
+    print('ONNX model saved ({0}).'.format(onnx_path))
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def yolo_boxes_and_scores(feats, anchors, num_classes, input_shape, image_shape):
+    '''NumPy version of yolo3.model.yolo_boxes_and_scores'''
+    num_anchors = len(anchors)
+    grid_shape = np.array(feats.shape[1:3]) # height, width
+    feats = feats.reshape(-1, grid_shape[0], grid_shape[1], num_anchors, num_classes + 5)
+
+    grid_y, grid_x = np.meshgrid(np.arange(grid_shape[0]), np.arange(grid_shape[1]), indexing='ij')
+    grid = np.stack([grid_x, grid_y], axis=-1)[:, :, np.newaxis, :].astype(feats.dtype)
+
+    box_xy = (sigmoid(feats[..., :2]) + grid) / grid_shape[::-1]
+    box_wh = np.exp(feats[..., 2:4]) * anchors / input_shape[::-1]
+    box_confidence = sigmoid(feats[..., 4:5])
+    box_class_probs = sigmoid(feats[..., 5:])
+
+    # Correct boxes for the letterbox padding and scale them to the image shape
+    box_yx = box_xy[..., ::-1]
+    box_hw = box_wh[..., ::-1]
+    new_shape = np.round(image_shape * np.min(input_shape / image_shape))
+    offset = (input_shape - new_shape) / 2. / input_shape
+    scale = input_shape / new_shape
+    box_yx = (box_yx - offset) * scale
+    box_hw = box_hw * scale
+    boxes = np.concatenate([box_yx - box_hw / 2., box_yx + box_hw / 2.], axis=-1)
+    boxes *= np.concatenate([image_shape, image_shape])
+
+    box_scores = box_confidence * box_class_probs
+    return boxes.reshape(-1, 4), box_scores.reshape(-1, num_classes)
+
+
+def non_max_suppression(boxes, scores, max_boxes, iou_threshold):
+    '''Greedy NMS on (y_min, x_min, y_max, x_max) boxes, returns the kept indices'''
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while order.size > 0 and len(keep) < max_boxes:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        mins = np.maximum(boxes[i, :2], boxes[rest, :2])
+        maxes = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        intersection = np.prod(np.clip(maxes - mins, 0, None), axis=1)
+        iou = intersection / (areas[i] + areas[rest] - intersection)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype='int32')
+
+
+def yolo_eval(yolo_outputs,
+              anchors,
+              num_classes,
+              image_shape,
+              max_boxes=20,
+              score_threshold=.6,
+              iou_threshold=.5):
+    '''NumPy version of yolo3.model.yolo_eval'''
+    num_layers = len(yolo_outputs)
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]] # default setting
+    input_shape = np.array(yolo_outputs[0].shape[1:3]) * 32
+    image_shape = np.array(image_shape, dtype='float32')
+    boxes = []
+    box_scores = []
+    for l in range(num_layers):
+        _boxes, _box_scores = yolo_boxes_and_scores(yolo_outputs[l],
+            anchors[anchor_mask[l]], num_classes, input_shape, image_shape)
+        boxes.append(_boxes)
+        box_scores.append(_box_scores)
+    boxes = np.concatenate(boxes, axis=0)
+    box_scores = np.concatenate(box_scores, axis=0)
+
+    mask = box_scores >= score_threshold
+    boxes_ = []
+    scores_ = []
+    classes_ = []
+    for c in range(num_classes):
+        class_boxes = boxes[mask[:, c]]
+        class_box_scores = box_scores[mask[:, c], c]
+        nms_index = non_max_suppression(class_boxes, class_box_scores, max_boxes, iou_threshold)
+        boxes_.append(class_boxes[nms_index])
+        scores_.append(class_box_scores[nms_index])
+        classes_.append(np.full(len(nms_index), c, dtype='int32'))
+
+    return np.concatenate(boxes_), np.concatenate(scores_), np.concatenate(classes_)
+
+
+class YOLOOnnx(object):
+    def __init__(self, onnx_path, anchors, num_classes, score_threshold=.6, iou_threshold=.5):
+        self.anchors = anchors
+        self.num_classes = num_classes
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.session = ort.InferenceSession(onnx_path,
+            providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        print('{} loaded with {}.'.format(onnx_path, self.session.get_providers()[0]))
+
+    def run(self, image_data, image_shape):
+        yolo_outputs = self.session.run(None, {self.input_name: image_data})
+        return yolo_eval(yolo_outputs, self.anchors, self.num_classes, image_shape,
+            score_threshold=self.score_threshold, iou_threshold=self.iou_threshold)
+
+    def close(self):
+        # ONNXRuntime sessions have no close(), releasing the session frees its resources
+        self.session = None
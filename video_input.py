@@ -17,3 +17,28 @@ class VideoInput():
         #if frame is not None:
         #    frame = Image.fromarray(frame)
         return frame
+
+
+class VideoInputAV():
+    def __init__(self, video_file, hwaccel=None):
+        self.video_file = video_file
+        self.hwaccel = hwaccel
+
+    def start(self):
+        # PyAV is optional, only needed for this input
+        import av
+
+        if self.hwaccel is not None:
+            from av.codec.hwaccel import HWAccel
+            self.container = av.open(self.video_file, hwaccel=HWAccel(device_type=self.hwaccel))
+        else:
+            self.container = av.open(self.video_file)
+        stream = self.container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        self.frames = self.container.decode(stream)
+
+    def get_current_frame(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            return None
+        return frame.to_ndarray(format='bgr24')